@@ -0,0 +1,26 @@
+"""
+Gunicorn configuration for the SIMAG API
+
+Usage:
+    gunicorn -c gunicorn.conf.py main:app
+"""
+
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+
+# Name matching is CPU-bound, so run one worker process per core
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import pandas, hazm and the app once in the master and share it via fork.
+# No database connection is opened at import time, so workers never share ODBC handles.
+preload_app = True
+
+# Recycle workers periodically to bound memory growth
+max_requests = 1000
+max_requests_jitter = 100
+
+# Large events can take a while to match
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
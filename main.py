@@ -1,23 +1,41 @@
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, Field, model_validator
 from typing import Optional, List
+from collections import OrderedDict
 import pandas as pd
+import pyarrow as pa
 import os
+import math
+import asyncio
+import time
+import orjson
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from urllib.parse import quote_plus
-from smart_name_matcher2 import SmartNameProcessor, Settings
+from arrow_odbc import read_arrow_batches_from_odbc, enable_odbc_connection_pooling
+from smart_name_matcher2 import SmartNameProcessor, Settings, get_normalizer
 import logging
 # from datetime import datetime
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+# Configure logging (LOG_LEVEL=DEBUG shows the per-step diagnostics)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+# Build the hazm Normalizer at startup (with preload_app, once for all workers) instead of on every request
+get_normalizer()
+
+# Rows fetched per ODBC round trip; the best value depends on the deployment
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "1000"))
+
+# In-memory result cache: entries live RESULT_CACHE_TTL seconds, at most
+# RESULT_CACHE_SIZE entries are kept and results bigger than
+# RESULT_CACHE_MAX_PAIRS pairs are not cached
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", "600"))
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "32"))
+RESULT_CACHE_MAX_PAIRS = int(os.getenv("RESULT_CACHE_MAX_PAIRS", "50000"))
+
 app = FastAPI(
     title="SIMAG API",
     description="API for Smart Name Matching and Database Connection",
@@ -51,121 +69,134 @@ class SimilarNamesResponse(BaseModel):
     pairs: List[SimilarNamePair] = Field(..., description="List of similar pairs")
 
 
+# Result column of find_similar_names -> SimilarNamePair field
+RESULT_FIELD_MAP = {
+    "نام اول": "name1",
+    "پست اول": "post1",
+    "سازمان اول": "org1",
+    "نوع سازمان اول": "org_type1",
+    "عنوان شرکت اول": "company1",
+    "عنوان هولدینگ اول": "holding1",
+    "شماره تلفن اول": "mobile1",
+    "نام دوم": "name2",
+    "پست دوم": "post2",
+    "سازمان دوم": "org2",
+    "نوع سازمان دوم": "org_type2",
+    "عنوان شرکت دوم": "company2",
+    "عنوان هولدینگ دوم": "holding2",
+    "شماره تلفن دوم": "mobile2",
+    "درصد تشابه": "similarity_score",
+}
+
+# Schema of the Arrow stream returned by /find-similar-names.arrow
+RESULT_ARROW_SCHEMA = pa.schema(
+    [(field, pa.float64() if field == "similarity_score" else pa.string()) for field in RESULT_FIELD_MAP.values()]
+)
+
+
 class ProcessRequest(BaseModel):
     """Request model for processing names"""
     id: int = Field(..., description="Event ID to filter data")
-    name_threshold: Optional[float] = Field(0.75, description="Name similarity threshold")
-    last_weight: Optional[float] = Field(0.40, description="Last name weight")
-    first_weight: Optional[float] = Field(0.20, description="First name weight")
-    org_weight: Optional[float] = Field(0.20, description="Organization weight")
-    post_weight: Optional[float] = Field(0.15, description="Post/position weight")
-    mobile_weight: Optional[float] = Field(0.05, description="Mobile number weight")
-    min_freq: Optional[int] = Field(5, description="Minimum frequency for stop names")
+    name_threshold: float = Field(0.75, ge=0.5, le=1.0, description="Name similarity threshold")
+    last_weight: float = Field(0.40, ge=0.0, le=1.0, description="Last name weight")
+    first_weight: float = Field(0.20, ge=0.0, le=1.0, description="First name weight")
+    org_weight: float = Field(0.20, ge=0.0, le=1.0, description="Organization weight")
+    post_weight: float = Field(0.15, ge=0.0, le=1.0, description="Post/position weight")
+    mobile_weight: float = Field(0.05, ge=0.0, le=1.0, description="Mobile number weight")
+    min_freq: int = Field(5, ge=1, le=100, description="Minimum frequency for stop names")
+
+    @model_validator(mode="after")
+    def check_weights(self):
+        """Reject weight combinations that do not add up to 1"""
+        total = self.last_weight + self.first_weight + self.org_weight + self.post_weight + self.mobile_weight
+        if not math.isclose(total, 1.0, abs_tol=1e-6):
+            raise ValueError(f"Weights must sum to 1.0 (got {total:.4f})")
+        return self
 
 
 # ✅ ---------------- DATABASE FUNCTIONS ----------------
-def get_db_connection():
-    """Create and return database connection"""
-    logger.info("🔵 [STEP 1] Starting database connection setup...")
-    
-    server = os.getenv('DB_SERVER')
-    database = os.getenv('DB_NAME')
-    username = os.getenv('DB_USERNAME')
-    password = os.getenv('DB_PASSWORD')
-    
-    logger.info(f"🔵 [STEP 2] Environment variables loaded - Server: {server}, Database: {database}, Username: {username}")
-    
-    if not all([server, database, username, password]):
-        logger.error("❌ [ERROR] Database credentials not found in environment variables")
-        raise ValueError("Database credentials not found in environment variables")
-    
-    logger.info("🔵 [STEP 3] Building connection string...")
-    conn_str = (
-        f"mssql+pyodbc://{quote_plus(username)}:{quote_plus(password)}"
-        f"@{server}/{database}?driver=ODBC+Driver+17+for+SQL+Server"
-    )
-    
-    logger.info("🔵 [STEP 4] Creating SQLAlchemy engine...")
-    try:
-        engine = create_engine(conn_str)
-        logger.info("✅ [SUCCESS] Engine created successfully (connection not yet established)")
-        return engine
-    except Exception as e:
-        logger.error(f"❌ [ERROR] Failed to create engine at STEP 4: {e}", exc_info=True)
-        raise
+# Let the ODBC driver manager keep connections open across requests
+# (must run before the first connection is made)
+enable_odbc_connection_pooling()
+
+
+def _odbc_quote(value: str) -> str:
+    """Quote a value for use inside an ODBC connection string"""
+    return "{" + value.replace("}", "}}") + "}"
+
+
+# Database settings are read once at startup; missing credentials fail fast
+DB_SERVER = os.getenv('DB_SERVER')
+DB_NAME = os.getenv('DB_NAME')
+DB_USERNAME = os.getenv('DB_USERNAME')
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+
+if not all([DB_SERVER, DB_NAME, DB_USERNAME, DB_PASSWORD]):
+    logger.error("❌ [ERROR] Database credentials not found in environment variables")
+    raise ValueError("Database credentials not found in environment variables (DB_SERVER, DB_NAME, DB_USERNAME, DB_PASSWORD)")
+
+DB_CONNECTION_STRING = (
+    "Driver={ODBC Driver 17 for SQL Server};"
+    f"Server={_odbc_quote(DB_SERVER)};"
+    f"Database={_odbc_quote(DB_NAME)};"
+    f"UID={_odbc_quote(DB_USERNAME)};"
+    f"PWD={_odbc_quote(DB_PASSWORD)};"
+)
+
+
+def _quote_identifier(name: str) -> str:
+    """Bracket-quote a SQL Server identifier"""
+    return "[" + name.replace("]", "]]") + "]"
+
+
+# Built once so SQL Server sees identical statement text and reuses the cached plan
+FETCH_QUERY = f"""
+SELECT [ID],
+       [FirstName],
+       [LastName],
+       [BankTitle],
+       [Post],
+       [OrganizationTitle],
+       [OrganizationTypeTitle],
+       [CompanyTitle],
+       [HoldingTitle],
+       [MobileNumber],
+       [IsHead]
+FROM {_quote_identifier(DB_NAME)}.[dbo].[vw_Guest_AI]
+WHERE [EventId] = ?
+"""
 
 
 def fetch_data_from_db(event_id: int):
     """Fetch data from database and return as DataFrame"""
-    logger.info(f"🟢 [FETCH_STEP 1] Preparing query for EventId={event_id}...")
-    
-    # Get database name from environment variables
-    database = os.getenv('DB_NAME')
-    if not database:
-        error_msg = "❌ [ERROR] DB_NAME not found in environment variables"
-        logger.error(error_msg)
-        raise ValueError(error_msg)
-    
-    logger.info(f"🟢 [FETCH_STEP 1.5] Using database name from env: {database}")
+    logger.debug(f"🟢 [FETCH_STEP 1] Preparing query for EventId={event_id}...")
     
-    query = text(f"""
-    SELECT [ID],
-           [FirstName],
-           [LastName],
-           [BankTitle],
-           [Post],
-           [OrganizationTitle],
-           [OrganizationTypeTitle],
-           [CompanyTitle],
-           [HoldingTitle],
-           [MobileNumber],
-           [IsHead]
-    FROM [{database}].[dbo].[vw_Guest_AI]
-    WHERE [EventId] = :event_id
-    """)
-    
-    engine = None
     try:
-        logger.info(f"🟢 [FETCH_STEP 2] Calling get_db_connection() for EventId={event_id}...")
-        engine = get_db_connection()
-        logger.info(f"✅ [FETCH_STEP 3] Engine obtained successfully for EventId={event_id}")
-        
-        # ✅ First, check if view exists and has any data
-        logger.info(f"🔍 [CHECK] Checking if view [{database}].[dbo].[vw_Guest_AI] exists and has data...")
-        try:
-            check_query = text(f"SELECT COUNT(*) as total_count FROM [{database}].[dbo].[vw_Guest_AI]")
-            count_df = pd.read_sql(check_query, engine)
-            total_count = count_df.iloc[0]['total_count'] if not count_df.empty else 0
-            logger.info(f"🔍 [CHECK] Total records in view: {total_count}")
-        except Exception as check_error:
-            logger.warning(f"⚠️ [WARNING] Could not check view total count: {check_error}")
-            logger.warning(f"⚠️ [WARNING] Continuing with main query despite check failure...")
-        
-        # ✅ Check available EventIds
-        logger.info(f"🔍 [CHECK] Checking available EventIds in view...")
-        try:
-            eventid_query = text(f"SELECT DISTINCT [EventId] FROM [{database}].[dbo].[vw_Guest_AI] ORDER BY [EventId]")
-            eventid_df = pd.read_sql(eventid_query, engine)
-            available_eventids = eventid_df['EventId'].tolist() if not eventid_df.empty else []
-            logger.info(f"🔍 [CHECK] Available EventIds in view: {available_eventids}")
-            logger.info(f"🔍 [CHECK] Requested EventId={event_id} is {'✅ FOUND' if event_id in available_eventids else '❌ NOT FOUND'} in available EventIds")
-        except Exception as eventid_error:
-            logger.warning(f"⚠️ [WARNING] Could not check available EventIds: {eventid_error}")
-            logger.warning(f"⚠️ [WARNING] Continuing with main query despite EventId check failure...")
-        
-        logger.info(f"🟢 [FETCH_STEP 4] Attempting to establish connection and execute query for EventId={event_id}...")
-        logger.info(f"🟢 [FETCH_STEP 4] Query: SELECT ... FROM [{database}].[dbo].[vw_Guest_AI] WHERE [EventId] = {event_id}")
-        logger.info(f"🟢 [FETCH_STEP 4] This is where the actual database connection happens (pd.read_sql)...")
-        df = pd.read_sql(query, engine, params={'event_id': event_id})
-        logger.info(f"✅ [FETCH_STEP 5] Query executed successfully! Fetched {len(df)} records from database for EventId={event_id}")
+        logger.debug(f"🟢 [FETCH_STEP 4] Attempting to establish connection and execute query for EventId={event_id}...")
+        logger.debug(f"🟢 [FETCH_STEP 4] Query: {FETCH_QUERY.strip()} -- EventId={event_id}")
+        logger.debug(f"🟢 [FETCH_STEP 4] This is where the actual database connection happens (arrow-odbc bulk fetch)...")
+        reader = read_arrow_batches_from_odbc(
+            query=FETCH_QUERY,
+            connection_string=DB_CONNECTION_STRING,
+            batch_size=DB_BATCH_SIZE,
+            parameters=[str(event_id)],
+        )
+        table = pa.Table.from_batches(reader, schema=reader.schema)
+        # Keep text columns Arrow-backed (one buffer per column instead of one object per cell)
+        df = table.to_pandas(types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get)
+        # NULL text would break normalization downstream; treat it as empty like load_excel does
+        text_cols = df.select_dtypes(include="string").columns
+        df[text_cols] = df[text_cols].fillna("")
+        logger.debug(f"✅ [FETCH_STEP 5] Query executed successfully! Fetched {len(df)} records from database for EventId={event_id}")
         
         if df.empty:
             logger.warning(f"⚠️ [WARNING] Query returned EMPTY result for EventId={event_id}")
             logger.warning(f"⚠️ [WARNING] This means no records match the EventId={event_id} in the view")
         else:
             logger.info(f"✅ [SUCCESS] Query returned {len(df)} records with columns: {list(df.columns)}")
-            # Show first few rows info
-            logger.info(f"📊 [DATA] First row sample: {df.iloc[0].to_dict() if len(df) > 0 else 'N/A'}")
+            if logger.isEnabledFor(logging.DEBUG):
+                # Show first few rows info
+                logger.debug(f"📊 [DATA] First row sample: {df.iloc[0].to_dict()}")
         
         # ✅ Save fetched data to file for inspection
         # COMMENTED: Disabled Excel file saving
@@ -208,12 +239,13 @@ def fetch_data_from_db(event_id: int):
         #     except Exception as csv_error:
         #         logger.error(f"❌ [ERROR] Could not save to CSV either: {csv_error}")
         
-        # Show summary statistics (without saving to file)
-        if not df.empty:
-            logger.info(f"📊 [DATA] Data summary:")
-            logger.info(f"📊 [DATA] - Total rows: {len(df)}")
-            logger.info(f"📊 [DATA] - Columns with data: {[col for col in df.columns if not df[col].isna().all()]}")
-            logger.info(f"📊 [DATA] - Columns all null: {[col for col in df.columns if df[col].isna().all()]}")
+        # Show summary statistics (without saving to file); the null scan touches every cell
+        if not df.empty and logger.isEnabledFor(logging.DEBUG):
+            all_null = df.isna().all()
+            logger.debug(f"📊 [DATA] Data summary:")
+            logger.debug(f"📊 [DATA] - Total rows: {len(df)}")
+            logger.debug(f"📊 [DATA] - Columns with data: {list(all_null.index[~all_null])}")
+            logger.debug(f"📊 [DATA] - Columns all null: {list(all_null.index[all_null])}")
         
         return df
     except HTTPException:
@@ -229,13 +261,35 @@ def fetch_data_from_db(event_id: int):
         logger.error(f"❌ [ERROR] Error message: {e}")
         logger.error(f"❌ [ERROR] Full traceback:", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
-    finally:
-        if engine:
-            try:
-                logger.info(f"🟡 [CLEANUP] Disposing engine for EventId={event_id}...")
-                engine.dispose()
-            except Exception as cleanup_error:
-                logger.warning(f"⚠️ [WARNING] Error during engine cleanup: {cleanup_error}")
+
+
+# ✅ ---------------- RESULT CACHE ----------------
+_result_cache = OrderedDict()
+
+
+def _cache_get(key):
+    """Return the cached response payload for key, or None if missing or expired"""
+    entry = _result_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, response = entry
+    if expires_at < time.monotonic():
+        del _result_cache[key]
+        return None
+    _result_cache.move_to_end(key)
+    return response
+
+
+def _cache_set(key, response):
+    """Store a response payload, evicting the least recently used entries"""
+    if RESULT_CACHE_TTL <= 0 or RESULT_CACHE_SIZE <= 0:
+        return
+    if response["total_pairs"] > RESULT_CACHE_MAX_PAIRS:
+        return
+    _result_cache[key] = (time.monotonic() + RESULT_CACHE_TTL, response)
+    _result_cache.move_to_end(key)
+    while len(_result_cache) > RESULT_CACHE_SIZE:
+        _result_cache.popitem(last=False)
 
 
 # ✅ ---------------- API ENDPOINTS ----------------
@@ -249,12 +303,51 @@ async def process_and_find_similar(request: ProcessRequest):
     2. Processes names (removes prefixes, corrects text)
     3. Finds similar names
     4. Returns result as JSON
+    
+    Results are cached in memory per request body for RESULT_CACHE_TTL seconds.
     """
+    payload = await get_similar_names(request)
+    
+    # Rows come straight from our own DataFrame, so skip per-pair model validation
+    return Response(content=orjson.dumps(payload), media_type="application/json")
+
+
+@app.post("/find-similar-names.arrow")
+async def process_and_find_similar_arrow(request: ProcessRequest):
+    """
+    Same as /find-similar-names, but returns the pairs as an Arrow IPC stream
+    
+    One record per pair with the SimilarNamePair fields as columns. Read it with
+    pyarrow.ipc.open_stream or polars.read_ipc_stream.
+    """
+    payload = await get_similar_names(request)
+    
+    table = pa.Table.from_pylist(payload["pairs"], schema=RESULT_ARROW_SCHEMA)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(content=sink.getvalue().to_pybytes(), media_type="application/vnd.apache.arrow.stream")
+
+
+async def get_similar_names(request: ProcessRequest) -> dict:
+    """Return the result payload for a request, from the cache when possible"""
+    cache_key = tuple(request.model_dump().items())
+    payload = _cache_get(cache_key)
+    if payload is not None:
+        logger.info(f"♻️ [CACHE] Returning cached result for EventId={request.id}")
+    else:
+        payload = await find_similar_for_request(request)
+        _cache_set(cache_key, payload)
+    return payload
+
+
+async def find_similar_for_request(request: ProcessRequest) -> dict:
+    """Run the fetch / process / match pipeline for one request"""
     try:
         # ✅ 1. Fetch data from database
         logger.info(f"Fetching data from database for EventId={request.id}...")
         try:
-            df = fetch_data_from_db(request.id)
+            df = await asyncio.to_thread(fetch_data_from_db, request.id)
         except HTTPException:
             # Re-raise HTTP exceptions (already properly formatted)
             raise
@@ -265,10 +358,7 @@ async def process_and_find_similar(request: ProcessRequest):
         
         if df.empty:
             logger.warning(f"⚠️ [WARNING] No data found for EventId={request.id}, returning empty result")
-            return SimilarNamesResponse(
-                total_pairs=0,
-                pairs=[]
-            )
+            return {"total_pairs": 0, "pairs": []}
         
         # ✅ 2. Processor settings
         try:
@@ -297,7 +387,7 @@ async def process_and_find_similar(request: ProcessRequest):
         # ✅ 4. Process names
         logger.info("Processing names (removing prefixes, correcting text)...")
         try:
-            processor.process_names()
+            await asyncio.to_thread(processor.process_names)
         except Exception as process_error:
             logger.error(f"❌ [ERROR] Failed to process names: {process_error}")
             logger.warning(f"⚠️ [WARNING] Continuing with unprocessed names...")
@@ -306,7 +396,7 @@ async def process_and_find_similar(request: ProcessRequest):
         # ✅ 5. Extract stop names
         logger.info("Extracting stop first names...")
         try:
-            processor.extract_stop_first_names(min_frequency=request.min_freq)
+            await asyncio.to_thread(processor.extract_stop_first_names, min_frequency=request.min_freq)
         except Exception as stop_error:
             logger.warning(f"⚠️ [WARNING] Failed to extract stop names: {stop_error}")
             logger.warning(f"⚠️ [WARNING] Continuing without stop names filter...")
@@ -315,7 +405,7 @@ async def process_and_find_similar(request: ProcessRequest):
         # ✅ 6. Find similar names
         logger.info("Finding similar names...")
         try:
-            df_result = processor.find_similar_names(output_path=None)  # Don't save to file
+            df_result = await asyncio.to_thread(processor.find_similar_names, output_path=None)  # Don't save to file
         except Exception as find_error:
             logger.error(f"❌ [ERROR] Failed to find similar names: {find_error}")
             logger.error(f"❌ [ERROR] Error type: {type(find_error).__name__}")
@@ -324,48 +414,21 @@ async def process_and_find_similar(request: ProcessRequest):
         # ✅ 7. Convert to JSON
         if df_result.empty:
             logger.info(f"ℹ️ [INFO] No similar names found for EventId={request.id}")
-            return SimilarNamesResponse(
-                total_pairs=0,
-                pairs=[]
-            )
+            return {"total_pairs": 0, "pairs": []}
         
         # Convert DataFrame to list of dictionaries
-        pairs = []
         try:
-            for _, row in df_result.iterrows():
-                try:
-                    pair = SimilarNamePair(
-                        name1=str(row.get("نام اول", "")),
-                        post1=str(row.get("پست اول", "")),
-                        org1=str(row.get("سازمان اول", "")),
-                        org_type1=str(row.get("نوع سازمان اول", "")),
-                        company1=str(row.get("عنوان شرکت اول", "")),
-                        holding1=str(row.get("عنوان هولدینگ اول", "")),
-                        mobile1=str(row.get("شماره تلفن اول", "")),
-                        name2=str(row.get("نام دوم", "")),
-                        post2=str(row.get("پست دوم", "")),
-                        org2=str(row.get("سازمان دوم", "")),
-                        org_type2=str(row.get("نوع سازمان دوم", "")),
-                        company2=str(row.get("عنوان شرکت دوم", "")),
-                        holding2=str(row.get("عنوان هولدینگ دوم", "")),
-                        mobile2=str(row.get("شماره تلفن دوم", "")),
-                        similarity_score=float(row.get("درصد تشابه", 0.0))
-                    )
-                    pairs.append(pair)
-                except Exception as pair_error:
-                    logger.warning(f"⚠️ [WARNING] Failed to process one pair: {pair_error}")
-                    logger.warning(f"⚠️ [WARNING] Skipping this pair and continuing...")
-                    continue
+            # One native list per column, zipped row-wise (no per-row Series or renamed copy)
+            fields = list(RESULT_FIELD_MAP.values())
+            columns = [df_result[col].tolist() for col in RESULT_FIELD_MAP]
+            pairs = [dict(zip(fields, row)) for row in zip(*columns)]
         except Exception as conversion_error:
             logger.error(f"❌ [ERROR] Failed to convert results to JSON format: {conversion_error}")
             raise HTTPException(status_code=500, detail=f"Failed to convert results: {str(conversion_error)}")
         
         logger.info(f"✅ [SUCCESS] Found {len(pairs)} similar name pairs")
         
-        return SimilarNamesResponse(
-            total_pairs=len(pairs),
-            pairs=pairs
-        )
+        return {"total_pairs": len(pairs), "pairs": pairs}
         
     except HTTPException:
         # Re-raise HTTP exceptions as-is (already properly formatted)
@@ -1,13 +1,156 @@
 import pandas as pd
+import numpy as np
 import re
+import codecs
 import logging
 import os
+import importlib.util
+import importlib.metadata
+import hashlib
+import multiprocessing
 from dataclasses import dataclass
+from collections import defaultdict
+from functools import lru_cache
 from hazm import Normalizer
 from rapidfuzz import fuzz, process
 import argparse
 import time  # Added for execution time logging
 
+# Last-name pre-filter: minimum partial_ratio, default max candidates kept per record,
+# and how many records are scored per cdist call (bounds the score matrix size)
+LAST_NAME_PREFILTER_CUTOFF = 50
+MAX_CANDIDATES_PER_RECORD = 100
+PREFILTER_CHUNK_SIZE = 256
+# Slack when pruning on a score upper bound: scores are compared after rounding to 3 decimals
+SCORE_BOUND_MARGIN = 0.001
+
+# Normalize in a process pool only when there are this many distinct text values;
+# below it, starting the workers (each loads hazm) costs more than it saves
+PARALLEL_NORMALIZE_MIN_VALUES = 50_000
+
+# Faster Excel engines when installed: python-calamine (Rust, pandas >= 2.2) for
+# reading and XlsxWriter for writing; otherwise pandas falls back to openpyxl
+_PANDAS_VERSION = tuple(int(part) for part in pd.__version__.split(".")[:2])
+EXCEL_READ_ENGINE = "calamine" if _PANDAS_VERSION >= (2, 2) and importlib.util.find_spec("python_calamine") else None
+EXCEL_WRITE_ENGINE = "xlsxwriter" if importlib.util.find_spec("xlsxwriter") else None
+# pyarrow reads and writes CSV with multi-threaded C++ code; otherwise pandas' C parser is used
+CSV_READ_ENGINE = "pyarrow" if importlib.util.find_spec("pyarrow") else "c"
+# The C parser's boolean spellings; pyarrow would also read 0/1 as booleans
+CSV_TRUE_VALUES = ["True", "TRUE", "true"]
+CSV_FALSE_VALUES = ["False", "FALSE", "false"]
+
+
+EXCEL_WRITE_CHUNK_ROWS = 10_000
+
+
+def read_csv(file_path, encoding):
+    """Read a CSV with the fastest available engine, falling back to the C parser for
+    files pyarrow rejects (e.g. rows with extra fields)"""
+    if CSV_READ_ENGINE == "pyarrow":
+        try:
+            return pd.read_csv(
+                file_path, encoding=encoding, engine="pyarrow",
+                true_values=CSV_TRUE_VALUES, false_values=CSV_FALSE_VALUES
+            )
+        except pd.errors.ParserError:
+            logging.warning("pyarrow could not parse the CSV file, falling back to the C parser.")
+    return pd.read_csv(file_path, encoding=encoding)
+
+
+def write_csv(df, output_path):
+    """Write a DataFrame to UTF-8 CSV with a BOM (so Excel shows Persian text), using
+    pyarrow's CSV writer when available"""
+    if CSV_READ_ENGINE != "pyarrow":
+        df.to_csv(output_path, index=False, encoding='utf-8-sig')
+        return
+    
+    import pyarrow as pa
+    import pyarrow.csv
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # e.g. an object column mixing strings and numbers
+        df.to_csv(output_path, index=False, encoding='utf-8-sig')
+        return
+    with open(output_path, "wb") as f:
+        f.write(codecs.BOM_UTF8)
+        pyarrow.csv.write_csv(table, f)
+
+
+def write_excel(df, output_path):
+    """Write a DataFrame to .xlsx with the fastest available engine
+
+    With XlsxWriter the sheet is streamed in constant_memory mode, so each row is flushed
+    to disk as soon as it is written. pandas' to_excel writes column by column, which
+    constant_memory cannot handle, so rows are written here directly.
+    """
+    if EXCEL_WRITE_ENGINE != "xlsxwriter":
+        df.to_excel(output_path, index=False)
+        return
+    
+    import xlsxwriter
+    with xlsxwriter.Workbook(output_path, {"constant_memory": True}) as workbook:
+        sheet = workbook.add_worksheet("Sheet1")
+        sheet.write_row(0, 0, [str(col) for col in df.columns], workbook.add_format({"bold": True}))
+        row_idx = 1
+        for start in range(0, len(df), EXCEL_WRITE_CHUNK_ROWS):
+            # Missing values become blank cells, as with to_excel
+            chunk = df.iloc[start:start + EXCEL_WRITE_CHUNK_ROWS].astype(object)
+            chunk = chunk.where(chunk.notna(), None)
+            for row in chunk.itertuples(index=False, name=None):
+                sheet.write_row(row_idx, 0, row)
+                row_idx += 1
+
+
+# Text columns cleaned by process_names
+TEXT_COLUMNS = ["FirstName", "LastName", "OrganizationTitle", "BankTitle", "Post", "OrganizationTypeTitle", "CompanyTitle", "HoldingTitle"]
+
+# Columns of the find_similar_names result, record 1 then record 2, then the score
+RESULT_COLUMNS = [
+    "نام اول", "پست اول", "سازمان اول", "نوع سازمان اول", "عنوان شرکت اول", "عنوان هولدینگ اول", "شماره تلفن اول",
+    "نام دوم", "پست دوم", "سازمان دوم", "نوع سازمان دوم", "عنوان شرکت دوم", "عنوان هولدینگ دوم", "شماره تلفن دوم",
+    "درصد تشابه"
+]
+
+_normalizer = None
+
+
+def get_normalizer():
+    """The process-wide hazm Normalizer, built on first use (construction takes seconds)"""
+    global _normalizer
+    if _normalizer is None:
+        _normalizer = Normalizer()
+    return _normalizer
+
+
+def clean_mobile(mobile):
+    """Digits of a mobile number, keeping the last 11 ('' when missing)"""
+    if not mobile:
+        return ""
+    return ''.join(filter(str.isdigit, str(mobile)))[-11:]
+
+
+def one_byte_texts(texts):
+    """texts with their characters renumbered into the one-byte range, keeping their order
+
+    rapidfuzz has a much faster path for one-byte strings than for Persian (two-byte) ones, and
+    an injective, order-preserving renumbering leaves every ratio unchanged. Texts using more
+    than 256 distinct characters are returned as they are.
+    """
+    chars = set().union(*map(set, texts))
+    if len(chars) > 256 or all(ord(c) < 256 for c in chars):
+        return texts
+    table = {ord(c): chr(code) for code, c in enumerate(sorted(chars))}
+    return [text.translate(table) for text in texts]
+
+
+# Names and titles repeat heavily (and across API requests), so normalize each distinct string only once
+@lru_cache(maxsize=100_000)
+def _normalize_text(text):
+    """Normalize one string with the process-wide Normalizer"""
+    return get_normalizer().normalize(text)
+
+
 # Settings
 @dataclass
 class Settings:
@@ -23,27 +166,58 @@ class Settings:
     org_threshold_for_post: float = 0.60  # Added: Threshold for organization similarity to calculate post (default 60% instead of 70%)
     use_shared_lastname_bonus: bool = True  # Added: Bonus when last names share common parts
     shared_lastname_bonus: float = 0.05  # Added: Bonus value for shared last name parts
-
-logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    blocking_key_length: int = 0  # Added: Only compare records whose last names share the first or last N characters (0 = compare all)
+    blocking_max_block_size: int = 0  # Added: With blocking, use disjoint blocks split on further characters until no bigger than this (0 = fixed prefix/suffix blocks)
+    max_candidates_per_record: int = MAX_CANDIDATES_PER_RECORD  # Added: Score only the best N pre-filter candidates of each record (0 = score all)
+    normalize_cache_dir: str = None  # Added: Keep normalized text columns as parquet files in this directory and reuse them for identical input (None = no cache)
 
 
 class SmartNameProcessor:
     def __init__(self, settings: Settings = Settings()):
         self.df = None
-        self.normalizer = Normalizer()
+        self._normalize = _normalize_text
         self.settings = settings
         self.input_file_format = None
 
-    def correct_text_vectorized(self, series):
-        return series.apply(self.normalizer.normalize)  # Still using apply as hazm is not vectorized, but fast enough for 3000 records
+    @property
+    def normalizer(self):
+        # Built on first use, so runs served from the normalize cache never load hazm's models
+        return get_normalizer()
+
+    def correct_text_vectorized(self, series, normalized=None):
+        # hazm is not vectorized, so normalize each distinct non-empty value once and
+        # map the column through the lookup table (empty cells are common in the optional columns)
+        non_empty = series != ""
+        values = series[non_empty]
+        if normalized is None:
+            normalized = {value: self._normalize(value) for value in values.unique()}
+        result = series.copy()
+        result[non_empty] = values.map(normalized)
+        return result
+
+    def _normalize_lookup(self, text_cols):
+        """Map every distinct non-empty value of the text columns to its normalized form"""
+        values = pd.unique(pd.concat([self.df[col] for col in text_cols], ignore_index=True))
+        values = [value for value in values if value != ""]
+        
+        processes = os.cpu_count() or 1
+        if processes < 2 or len(values) < PARALLEL_NORMALIZE_MIN_VALUES:
+            return {value: self._normalize(value) for value in values}
+        
+        logging.info(f"Normalizing {len(values)} distinct values with {processes} processes...")
+        # spawn rather than fork: the API calls this from a thread of a running server
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            normalized = pool.map(_normalize_text, values, chunksize=1000)
+        return dict(zip(values, normalized))
 
     def load_excel(self, file_path):
         file_ext = os.path.splitext(file_path)[1].lower()
         if file_ext == '.csv':
-            encodings = ['utf-8-sig', 'utf-8', 'cp1256', 'latin-1']
+            # utf-8-sig also reads plain UTF-8 (pyarrow would not reject bad bytes under 'utf-8')
+            encodings = ['utf-8-sig', 'cp1256', 'latin-1']
             for enc in encodings:
                 try:
-                    self.df = pd.read_csv(file_path, encoding=enc)
+                    self.df = read_csv(file_path, enc)
                     break
                 except UnicodeDecodeError:
                     continue
@@ -51,7 +225,7 @@ class SmartNameProcessor:
                 raise ValueError("Could not decode CSV file.")
             self.input_file_format = 'csv'
         elif file_ext in ['.xlsx', '.xls']:
-            self.df = pd.read_excel(file_path)
+            self.df = pd.read_excel(file_path, engine=EXCEL_READ_ENGINE)
             self.input_file_format = 'excel'
         else:
             raise ValueError("Unsupported file format.")
@@ -71,18 +245,56 @@ class SmartNameProcessor:
         
         # Fill NaN with empty string for safety
         self.df.fillna("", inplace=True)
+        
+        # Keep the text columns as Arrow-backed strings: less memory than Python str objects,
+        # and the .str / comparison ops in process_names run on Arrow buffers
+        if importlib.util.find_spec("pyarrow"):
+            for col in TEXT_COLUMNS:
+                if col in self.df.columns:
+                    self.df[col] = self.df[col].astype(pd.StringDtype("pyarrow"))
         return self.df
 
     def process_names(self):
         # self.df["FirstName"] = self.correct_text_vectorized(self.df["FirstName"])
         # self.df["LastName"] = self.correct_text_vectorized(self.df["LastName"])
         
-        text_cols = ["FirstName", "LastName", "OrganizationTitle", "BankTitle", "Post", "OrganizationTypeTitle", "CompanyTitle", "HoldingTitle"]
+        text_cols = [col for col in TEXT_COLUMNS if col in self.df.columns]
+        if not text_cols:
+            return
+        cache_path = self._normalize_cache_path(text_cols)
+        if cache_path and os.path.exists(cache_path):
+            cached = pd.read_parquet(cache_path)
+            for col in text_cols:
+                # Normalizing keeps each column's dtype; parquet reads strings back as string[python]
+                self.df[col] = cached[col].astype(self.df[col].dtype).set_axis(self.df.index)
+            logging.info(f"Normalized names loaded from cache {cache_path}.")
+            return
+        
+        # One normalization pass over the values of all columns (titles repeat across
+        # columns), then each column is mapped through the shared lookup
+        normalized = self._normalize_lookup(text_cols)
         for col in text_cols:
-            if col in self.df.columns:
-                self.df[col] = self.correct_text_vectorized(self.df[col])
+            self.df[col] = self.correct_text_vectorized(self.df[col], normalized)
 
         logging.info("Names processed (vectorized where possible).")
+        
+        if cache_path:
+            try:
+                os.makedirs(self.settings.normalize_cache_dir, exist_ok=True)
+                self.df[text_cols].to_parquet(cache_path, index=False)
+            except Exception as e:
+                # Caching is best effort (e.g. columns mixing strings and numbers cannot be written)
+                logging.warning(f"Could not write normalize cache {cache_path}: {e}")
+
+    def _normalize_cache_path(self, text_cols):
+        """Parquet file for the normalized text columns, keyed on their raw content and the
+        hazm version; None when caching is off or pyarrow is missing"""
+        if not self.settings.normalize_cache_dir or not importlib.util.find_spec("pyarrow"):
+            return None
+        digest = hashlib.sha1()
+        digest.update(repr((text_cols, importlib.metadata.version("hazm"))).encode())
+        digest.update(pd.util.hash_pandas_object(self.df[text_cols], index=False).to_numpy().tobytes())
+        return os.path.join(self.settings.normalize_cache_dir, f"{digest.hexdigest()}.parquet")
 
     def save(self, output_path):
         output_ext = os.path.splitext(output_path)[1].lower()
@@ -91,94 +303,109 @@ class SmartNameProcessor:
             output_path += output_ext
         
         if output_ext == '.csv':
-            self.df.to_csv(output_path, index=False, encoding='utf-8-sig')
+            write_csv(self.df, output_path)
         else:
-            self.df.to_excel(output_path, index=False)
+            write_excel(self.df, output_path)
         logging.info(f"Saved to {output_path}")
 
     def smart_score(self, f1, l1, f2, l2, org1="", org2="", bank1="", bank2="", post1="", post2="", mobile1="", mobile2="", stop_first_names_set=None):
+        return self.score_candidates(
+            f1, l1, org1, bank1, post1, clean_mobile(mobile1),
+            [f2], [l2], [org2], [bank2], [post2], [clean_mobile(mobile2)],
+            stop_first_names_set
+        )[0]
+
+    def score_candidates(self, f1, l1, org1, bank1, post1, mobile1,
+                         firsts, lasts, orgs, banks, posts, mobiles,
+                         stop_first_names_set=None, l1_words=None, lasts_words=None,
+                         is_stop1=None, candidates_is_stop=None, min_score=None):
+        """smart_score of one record against many candidate records at once
+
+        The candidate arguments are equal-length lists, mobile numbers already passed through
+        clean_mobile. Every fuzz ratio is one cdist row and the weighting runs as NumPy array
+        arithmetic in the same order as the scalar formula, so the scores are identical.
+        lasts_words optionally holds each candidate's last-name word set, and is_stop1 /
+        candidates_is_stop precomputed stop-name flags (bool and bool array) replacing the set lookups.
+        With min_score, candidates whose name similarities cannot reach it even with every other
+        field at its maximum skip the remaining scoring and get 0.0.
+        Returns a list of scores rounded to 3 decimals.
+        """
+        n = len(firsts)
+        
         # Use max of token_sort_ratio and partial_ratio for names to handle cases where
         # one name is a subset of another (e.g., "پریسا ساعدی" vs "پریسا ساعدی خسروشاهی")
-        first_token = fuzz.token_sort_ratio(f1, f2) / 100
-        first_partial = fuzz.partial_ratio(f1, f2) / 100
-        first_sim = max(first_token, first_partial)
+        first_sim = np.maximum(self._batch_ratios(f1, firsts, fuzz.token_sort_ratio),
+                               self._batch_ratios(f1, firsts, fuzz.partial_ratio))
+        last_partial = self._batch_ratios(l1, lasts, fuzz.partial_ratio)
+        last_sim = np.maximum(self._batch_ratios(l1, lasts, fuzz.token_sort_ratio), last_partial)
         
-        last_token = fuzz.token_sort_ratio(l1, l2) / 100
-        last_partial = fuzz.partial_ratio(l1, l2) / 100
-        last_sim = max(last_token, last_partial)
+        if candidates_is_stop is None and stop_first_names_set:
+            is_stop1 = f1 in stop_first_names_set
+            candidates_is_stop = np.fromiter((f2 in stop_first_names_set for f2 in firsts), dtype=bool, count=n)
+        if candidates_is_stop is not None:
+            if is_stop1:
+                first_sim = first_sim * self.settings.stop_penalty  # Configurable penalty
+            else:
+                first_sim = np.where(candidates_is_stop, first_sim * self.settings.stop_penalty, first_sim)
         
-        if stop_first_names_set and (f1 in stop_first_names_set or f2 in stop_first_names_set):
-            first_sim *= self.settings.stop_penalty  # Configurable penalty
+        kept = None
+        if min_score is not None and n:
+            upper = self._score_upper_bound(last_sim, first_sim, bool(bank1), bool(l1))
+            if upper is not None:
+                kept = np.flatnonzero(upper >= min_score - SCORE_BOUND_MARGIN)
+                picks = kept.tolist()
+                lasts, orgs, banks, posts, mobiles = (
+                    [values[k] for k in picks] for values in (lasts, orgs, banks, posts, mobiles)
+                )
+                if lasts_words is not None:
+                    lasts_words = [lasts_words[k] for k in picks]
+                first_sim, last_sim, last_partial = first_sim[kept], last_sim[kept], last_partial[kept]
+                n_all, n = n, len(picks)
         
         # Use max of token_sort_ratio and partial_ratio for organization to better handle
         # cases where one organization name is a subset of another
         # BUT: Avoid false positives when one string is a short substring of another
         # Only use partial_ratio if the shorter string is a significant portion (>=50%) of the longer one
         # (e.g., "مرکزی" is only 13.5% of "پتروشیمی شازند اراک -دفتر مرکزی تهران" - not significant)
-        org_token = fuzz.token_sort_ratio(org1, org2) / 100 if org1 and org2 else 0
-        org_partial = fuzz.partial_ratio(org1, org2) / 100 if org1 and org2 else 0
-        
-        if org1 and org2:
-            len_ratio = min(len(org1), len(org2)) / max(len(org1), len(org2))
-            # If shorter string is less than 50% of longer string AND partial is much higher than token,
-            # it's probably just a small substring match, not real similarity - use token_sort_ratio
-            # This prevents cases like "مرکزی" matching "پتروشیمی شازند اراک -دفتر مرکزی تهران"
-            if len_ratio < 0.5 and org_partial > org_token + 0.3:
-                org_sim = org_token
-            else:
-                # If shorter string is >= 50% of longer, it's a significant portion - use partial_ratio
-                org_sim = max(org_token, org_partial)
-        else:
-            org_sim = max(org_token, org_partial)
+        org_sim = self._substring_aware_sims(org1, orgs)
         
         # Only calculate post similarity if organization similarity meets threshold (default 60% instead of 70%)
-        if org_sim >= self.settings.org_threshold_for_post and post1 and post2:
+        post_sim = np.zeros(n)
+        post_eligible = org_sim >= self.settings.org_threshold_for_post
+        if post1 and post_eligible.any():
             # Apply same logic for post: only use partial_ratio if shorter string is >=50% of longer one
-            post_token = fuzz.token_sort_ratio(post1, post2) / 100
-            post_partial = fuzz.partial_ratio(post1, post2) / 100
-            len_ratio_post = min(len(post1), len(post2)) / max(len(post1), len(post2)) if post1 and post2 else 1
-            # If shorter string is less than 50% of longer string AND partial is much higher than token,
-            # it's probably just a small substring match - use token_sort_ratio
-            if len_ratio_post < 0.5 and post_partial > post_token + 0.3:
-                post_sim = post_token
-            else:
-                # If shorter string is >= 50% of longer, it's a significant portion - use partial_ratio
-                post_sim = max(post_token, post_partial)
-        else:
-            post_sim = 0
+            post_sim = np.where(post_eligible, self._substring_aware_sims(post1, posts), 0.0)
         
-        mobile_sim = 0
-        if mobile1 and mobile2:
-            mobile1_clean = ''.join(filter(str.isdigit, str(mobile1)))[-11:]
-            mobile2_clean = ''.join(filter(str.isdigit, str(mobile2)))[-11:]
-            
-            if len(mobile1_clean) >= 10 and len(mobile2_clean) >= 10:
-                similarity = fuzz.ratio(mobile1_clean, mobile2_clean) / 100.0
-                
-                if similarity >= 0.80:
-                    mobile_sim = (similarity - 0.80) * 0.5
-                else:
-                    mobile_sim = 0 
+        # Mobile numbers only count when both have at least 10 digits and are >= 80% similar
+        mobile_sim = np.zeros(n)
+        if len(mobile1) >= 10:
+            # score_cutoff lets rapidfuzz stop early; anything below 80 comes back as 0
+            similarity = self._batch_ratios(mobile1, mobiles, fuzz.ratio, score_cutoff=80)
+            valid = np.fromiter((len(mobile2) >= 10 for mobile2 in mobiles), dtype=bool, count=n)
+            mobile_sim = np.where(valid & (similarity >= 0.80), (similarity - 0.80) * 0.5, 0.0)
         
-        bank_bonus = 0
-        last_weight = self.settings.last_name_weight
-        if self.settings.use_bank_bonus and bank1 and bank2:  # Check for use_bank_bonus option
-            bank_sim = fuzz.ratio(bank1, bank2) / 100
-            if bank_sim >= 0.8:
-                bank_bonus = 0.05
-                last_weight -= 0.05
+        bank_bonus = np.zeros(n)
+        last_weight = np.full(n, self.settings.last_name_weight)
+        if self.settings.use_bank_bonus and bank1:  # Check for use_bank_bonus option
+            # Compare in rapidfuzz's 0-100 space with an early-exit cutoff (0 means below 80)
+            bank_hit = (self._batch_ratios(bank1, banks, fuzz.ratio, score_cutoff=80) > 0) & self._non_empty(banks)
+            bank_bonus = np.where(bank_hit, 0.05, 0.0)
+            last_weight = np.where(bank_hit, self.settings.last_name_weight - 0.05, last_weight)
         
         # Bonus for shared last name parts (e.g., "نجفی" in "نجفی مطیعی")
-        shared_lastname_bonus = 0
-        if self.settings.use_shared_lastname_bonus and l1 and l2:
-            # Check if one last name contains the other (after normalization)
-            l1_words = set(l1.split())
-            l2_words = set(l2.split())
-            # If there are common words or one is subset of another
-            if l1_words.intersection(l2_words) or (l1 in l2 or l2 in l1):
-                # Only give bonus if partial_ratio is high (meaning significant overlap)
-                if last_partial >= 0.8:
-                    shared_lastname_bonus = self.settings.shared_lastname_bonus
+        shared_lastname_bonus = np.zeros(n)
+        if self.settings.use_shared_lastname_bonus and l1:
+            if l1_words is None:
+                l1_words = set(l1.split())
+            # Only give bonus if partial_ratio is high (meaning significant overlap)
+            for k in np.flatnonzero(last_partial >= 0.8).tolist():
+                l2 = lasts[k]
+                if not l2:
+                    continue
+                l2_words = lasts_words[k] if lasts_words is not None else set(l2.split())
+                # If there are common words or one is subset of another
+                if not l1_words.isdisjoint(l2_words) or (l1 in l2 or l2 in l1):
+                    shared_lastname_bonus[k] = self.settings.shared_lastname_bonus
         
         score = (
             last_weight * last_sim +
@@ -189,7 +416,53 @@ class SmartNameProcessor:
             bank_bonus +
             shared_lastname_bonus
         )
-        return round(score, 3)
+        if kept is not None:
+            all_scores = np.zeros(n_all)
+            all_scores[kept] = score
+            score = all_scores
+        return [round(value, 3) for value in score.tolist()]
+
+    def _score_upper_bound(self, last_sim, first_sim, has_bank, has_last_name):
+        """Highest score each candidate could still get given its name similarities, taking
+        org, post and mobile at their maximum and every applicable bonus; None when negative
+        weights make the bound unsafe"""
+        s = self.settings
+        bank_bonus = 0.05 if s.use_bank_bonus and has_bank else 0.0
+        shared_bonus = s.shared_lastname_bonus if s.use_shared_lastname_bonus and has_last_name else 0.0
+        if min(s.last_name_weight - bank_bonus, s.first_name_weight, s.org_weight, s.post_weight,
+               s.mobile_weight, shared_bonus) < 0:
+            return None
+        # A bank match trades 0.05 of the last-name weight for a 0.05 bonus; mobile adds at most (1 - 0.8) * 0.5
+        return (
+            s.last_name_weight * last_sim + bank_bonus * (1 - last_sim) +
+            s.first_name_weight * first_sim +
+            s.org_weight + s.post_weight + s.mobile_weight * 0.1 +
+            shared_bonus
+        )
+
+    def _substring_aware_sims(self, text1, texts):
+        """max(token_sort_ratio, partial_ratio) / 100 of text1 against each text, except that
+        a short text matching inside a much longer one (length ratio < 0.5 and partial more than
+        0.3 above token) falls back to token_sort_ratio; 0 where either side is empty"""
+        n = len(texts)
+        if not text1:
+            return np.zeros(n)
+        token = self._batch_ratios(text1, texts, fuzz.token_sort_ratio)
+        partial = self._batch_ratios(text1, texts, fuzz.partial_ratio)
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=n)
+        # text1 is non-empty, so the maximum is never 0
+        len_ratio = np.minimum(len(text1), lengths) / np.maximum(len(text1), lengths)
+        sims = np.where((len_ratio < 0.5) & (partial > token + 0.3), token, np.maximum(token, partial))
+        return np.where(lengths > 0, sims, 0.0)
+
+    @staticmethod
+    def _non_empty(texts):
+        return np.fromiter(map(bool, texts), dtype=bool, count=len(texts))
+
+    @staticmethod
+    def _batch_ratios(query, choices, scorer, **kwargs):
+        """scorer(query, choice) / 100 for every choice, with the query processed once"""
+        return process.cdist([query], choices, scorer=scorer, dtype=np.float64, **kwargs)[0] / 100
 
     def extract_stop_first_names(self, min_frequency=5):
         first_names = self.df["FirstName"].astype(str).str.strip()
@@ -201,117 +474,227 @@ class SmartNameProcessor:
         self.settings.stop_first_names = list(freq[freq >= min_frequency].index)
         logging.info(f"Extracted stop first names: {self.settings.stop_first_names}")
 
+    def _last_name_candidates(self, last_names, first_names):
+        """Yield (i, later record indices, partial_ratio scores) that pass the last-name pre-filter"""
+        if self.settings.blocking_key_length > 0:
+            yield from self._blocked_last_name_candidates(last_names, first_names, one_byte_texts(last_names))
+            return
+        
+        # Score a chunk of records against every record at or after the chunk start in one
+        # native cdist call (multi-threaded, scores below the cutoff come back as 0).
+        # Last names repeat a lot, so the call only scores distinct names and each
+        # record's row is gathered back from its name's codes
+        codes, uniques = pd.factorize(np.asarray(last_names, dtype=object))
+        for start in range(0, len(last_names), PREFILTER_CHUNK_SIZE):
+            # Codes follow first appearance, so the chunk (a prefix of the slice) uses 0..k-1
+            later_codes, later_uniques = pd.factorize(codes[start:])
+            chunk_codes = later_codes[:PREFILTER_CHUNK_SIZE]
+            names = one_byte_texts(uniques[later_uniques].tolist())
+            name_scores = process.cdist(
+                names[:chunk_codes.max() + 1], names,
+                scorer=fuzz.partial_ratio, score_cutoff=LAST_NAME_PREFILTER_CUTOFF, workers=-1
+            )
+            for offset, code in enumerate(chunk_codes):
+                i = start + offset
+                later_scores = name_scores[code][later_codes[offset + 1:]]
+                candidate_js = np.flatnonzero(later_scores)
+                yield i, candidate_js + i + 1, later_scores[candidate_js]
+    
+    def _adaptive_blocks(self, last_names, first_names):
+        """Disjoint blocks of record indices keyed on a last-name prefix; a block bigger than
+        blocking_max_block_size is split on one more character, moving on to the first name
+        once the last name is used up"""
+        keys = [f"{last_name}\0{first_name}" for last_name, first_name in zip(last_names, first_names)]
+        max_size = self.settings.blocking_max_block_size
+        blocks = []
+        pending = [(self.settings.blocking_key_length, list(range(len(keys))))]
+        while pending:
+            key_len, members = pending.pop()
+            groups = defaultdict(list)
+            for m in members:
+                groups[keys[m][:key_len]].append(m)
+            for prefix, group in groups.items():
+                # A prefix shorter than key_len is a whole key: identical records, nothing left to split on
+                if len(group) > max_size and len(prefix) == key_len:
+                    pending.append((key_len + 1, group))
+                else:
+                    blocks.append(group)
+        return blocks
+
+    def _blocked_last_name_candidates(self, last_names, first_names, match_names):
+        """Like _last_name_candidates, but only within blocks of records sharing a last-name prefix
+        or suffix; match_names are the last names as passed to cdist"""
+        key_len = self.settings.blocking_key_length
+        pair_is, pair_js, pair_scores = [], [], []
+        
+        if self.settings.blocking_max_block_size > 0:
+            block_passes = [self._adaptive_blocks(last_names, first_names)]
+        else:
+            # Second pass on the suffix recovers pairs whose prefixes differ
+            block_passes = []
+            for block_key in (lambda name: name[:key_len], lambda name: name[-key_len:]):
+                blocks = defaultdict(list)
+                for i, last_name in enumerate(last_names):
+                    blocks[block_key(last_name)].append(i)
+                block_passes.append(blocks.values())
+        
+        for blocks in block_passes:
+            for members in blocks:
+                if len(members) < 2:
+                    continue
+                block_scores = process.cdist(
+                    [match_names[m] for m in members], [match_names[m] for m in members],
+                    scorer=fuzz.partial_ratio, score_cutoff=LAST_NAME_PREFILTER_CUTOFF, workers=-1
+                )
+                # members are in record order, so the upper triangle holds (earlier, later) pairs
+                a, b = np.nonzero(np.triu(block_scores, k=1))
+                members = np.asarray(members, dtype=np.intp)
+                pair_is.append(members[a])
+                pair_js.append(members[b])
+                pair_scores.append(block_scores[a, b])
+        
+        if not pair_is:
+            return
+        pair_is = np.concatenate(pair_is)
+        pair_js = np.concatenate(pair_js)
+        pair_scores = np.concatenate(pair_scores)
+        
+        # Pairs found by both passes appear twice; unique on the packed (i, j) key drops the
+        # repeats and sorts by i, then j
+        _, first = np.unique(pair_is.astype(np.int64) * len(last_names) + pair_js, return_index=True)
+        pair_is, pair_js, pair_scores = pair_is[first], pair_js[first], pair_scores[first]
+        logging.info(f"Blocking from {key_len} last-name characters kept {len(pair_is)} candidate pairs.")
+        
+        bounds = np.flatnonzero(np.diff(pair_is)) + 1
+        for start, stop in zip([0, *bounds.tolist()], [*bounds.tolist(), len(pair_is)]):
+            yield int(pair_is[start]), pair_js[start:stop], pair_scores[start:stop]
+
     def find_similar_names(self, output_path="final_smart_similar_names.xlsx"):
-        # Pre-extract all data once to avoid repeated df.loc calls
-        records = []
-        for idx, row in self.df.iterrows():
-            first_name = str(row["FirstName"]).strip()
-            last_name = str(row["LastName"]).strip()
-            if first_name or last_name:  # Keep even if one is empty
-                # Pre-extract all columns we'll need
-                org = str(row.get("OrganizationTitle", ""))
-                bank = str(row.get("BankTitle", ""))
-                post = str(row.get("Post", ""))
-                phone = str(row.get("MobileNumber", ""))
-                org_type = str(row.get("OrganizationTypeTitle", ""))
-                company = str(row.get("CompanyTitle", ""))
-                holding = str(row.get("HoldingTitle", ""))
-                is_head = row.get("IsHead", None)
-                
-                records.append((idx, first_name, last_name, org, bank, post, phone, 
-                              org_type, company, holding, is_head))
+        # Pre-extract every column once as a plain list (no per-row Series from iterrows)
+        n_rows = len(self.df)
+        
+        def text_column(col):
+            if col not in self.df.columns:
+                return [""] * n_rows
+            return [str(value) for value in self.df[col].tolist()]
+        
+        first_col = [name.strip() for name in text_column("FirstName")]
+        last_col = [name.strip() for name in text_column("LastName")]
+        # Keep even if one of first/last name is empty
+        keep = [k for k in range(n_rows) if first_col[k] or last_col[k]]
+        
+        first_names = [first_col[k] for k in keep]
+        last_names = [last_col[k] for k in keep]
+        orgs, banks, posts, phones, org_types, companies, holdings = (
+            [column[k] for k in keep] for column in map(text_column, [
+                "OrganizationTitle", "BankTitle", "Post", "MobileNumber",
+                "OrganizationTypeTitle", "CompanyTitle", "HoldingTitle"
+            ])
+        )
+        is_head_col = self.df["IsHead"].tolist() if "IsHead" in self.df.columns else [None] * n_rows
+        is_heads = [is_head_col[k] for k in keep]
+        # Mobile digits for scoring, cleaned once per record
+        mobiles = [clean_mobile(phone) for phone in phones]
+        # Word sets of each last name, for the shared-last-name bonus
+        last_name_words = [set(last_name.split()) for last_name in last_names]
+        # "First Last" once per record, used for pair dedup and output
+        full_names = (
+            pd.Series(first_names, dtype=object)
+            .str.cat(pd.Series(last_names, dtype=object), sep=" ")
+            .str.strip()
+            .tolist()
+        )
+        # Pairs are deduplicated by full name; an int code per distinct name keeps the keys cheap
+        name_codes, name_uniques = pd.factorize(np.asarray(full_names, dtype=object))
+        name_codes = name_codes.tolist()
+        n_names = len(name_uniques)
         
-        # Convert stop_first_names to set for O(1) lookup
+        # Convert stop_first_names to set for O(1) lookup, then flag each record once
         stop_first_names_set = set(self.settings.stop_first_names) if self.settings.stop_first_names else set()
+        is_stop = np.fromiter((f in stop_first_names_set for f in first_names), dtype=bool, count=len(first_names))
         
-        results = []
+        # Accepted pairs are kept as record positions plus score; output columns are
+        # gathered from the per-record lists in one pass at the end
+        pair_is = []
+        pair_js = []
+        pair_scores = []
         seen_pairs = set()
         
-        logging.info(f"Dataset size: {len(records)}. Using optimized last_name-based pre-filter.")
+        logging.info(f"Dataset size: {len(keep)}. Using optimized last_name-based pre-filter.")
         
-        for i in range(len(records)):
-            idx1, f1, l1, org1, bank1, post1, phone1, org_type1, company1, holding1, is_head1 = records[i]
-            name1_full = f"{f1} {l1}".strip()
+        max_candidates = self.settings.max_candidates_per_record
+        for i, candidate_js, last_sim_scores in self._last_name_candidates(last_names, first_names):
+            f1, l1, org1, bank1, post1 = first_names[i], last_names[i], orgs[i], banks[i], posts[i]
+            code1 = name_codes[i]
             
-            # Only process records ahead to avoid duplicates
-            other_records = records[i+1:]
+            # Limit to top candidates by last name similarity to avoid too many smart_score calls
+            if 0 < max_candidates < len(candidate_js):
+                # Stable sort keeps record order among equal scores
+                order = np.argsort(-last_sim_scores, kind="stable")
+                candidate_js = candidate_js[order[:max_candidates]]
             
-            if not other_records:
+            if not len(candidate_js):
                 continue
+            candidate_js = candidate_js.tolist()
             
-            # Optimized pre-filter: use faster partial_ratio directly instead of process.extract
-            # This avoids the overhead of process.extract for each record
-            candidate_indices = []
-            for j, (idx2, f2, l2, _, _, _, _, _, _, _, _) in enumerate(other_records):
-                # Quick last name similarity check (faster than process.extract)
-                last_sim_score = fuzz.partial_ratio(l1, l2)
-                if last_sim_score >= 50:  # Only if last name similarity >= 50%
-                    candidate_indices.append((j, idx2, f2, l2, last_sim_score))
-            
-            # Limit to top candidates by last name similarity to avoid too many smart_score calls
-            if len(candidate_indices) > 100:
-                # Sort by last name similarity (already computed) and take top 100
-                candidate_indices.sort(key=lambda x: x[4], reverse=True)  # x[4] is last_sim_score
-                candidate_indices = candidate_indices[:100]
+            # Check if names are exactly the same (after normalization) - include regardless of threshold.
+            # Their score is fixed below, so only the other candidates need scoring
+            exact_matches = [first_names[j] == f1 and last_names[j] == l1 for j in candidate_js]
+            score_js = [j for j, exact_name_match in zip(candidate_js, exact_matches) if not exact_name_match]
             
-            # Remove the similarity score from tuples before processing
-            candidate_indices = [(j, idx2, f2, l2) for j, idx2, f2, l2, _ in candidate_indices]
+            # Score the remaining candidates of this record in one batch
+            scores = iter(self.score_candidates(
+                f1, l1, org1, bank1, post1, mobiles[i],
+                [first_names[j] for j in score_js], [last_names[j] for j in score_js],
+                [orgs[j] for j in score_js], [banks[j] for j in score_js],
+                [posts[j] for j in score_js], [mobiles[j] for j in score_js],
+                stop_first_names_set, last_name_words[i], [last_name_words[j] for j in score_js],
+                is_stop[i], is_stop[score_js], min_score=self.settings.name_threshold
+            ) if score_js else [])
             
-            for j, idx2, f2, l2 in candidate_indices:
-                # Get pre-extracted data for record 2
-                _, _, _, org2, bank2, post2, phone2, org_type2, company2, holding2, is_head2 = other_records[j]
-                name2_full = f"{f2} {l2}".strip()
-                
-                final_score = self.smart_score(f1, l1, f2, l2, org1, org2, bank1, bank2, post1, post2, phone1, phone2, stop_first_names_set)
-                
-                # Check if names are exactly the same (after normalization) - include regardless of threshold
-                exact_name_match = (f1 == f2 and l1 == l2)
-                
+            for j, exact_name_match in zip(candidate_js, exact_matches):
                 # If names are exactly the same, set score to 0.8 (80%) to ensure they appear at the top of the list
-                if exact_name_match:
-                    final_score = 0.8
+                final_score = 0.8 if exact_name_match else next(scores)
                 
                 if exact_name_match or final_score >= self.settings.name_threshold:
-                    pair_key = tuple(sorted([name1_full, name2_full]))
+                    code2 = name_codes[j]
+                    pair_key = min(code1, code2) * n_names + max(code1, code2)
                     if pair_key not in seen_pairs:
                         seen_pairs.add(pair_key)
-                        
-                        # Modify organization title for output: if IsHead is False (0), append BankTitle with dash
-                        org1_output = org1
-                        org2_output = org2
-                        
-                        if is_head1 is not None and (is_head1 == 0 or is_head1 == False):
-                            if bank1 and bank1.strip():
-                                org1_output = f"{org1} - {bank1}".strip() if org1 else bank1
-                        
-                        if is_head2 is not None and (is_head2 == 0 or is_head2 == False):
-                            if bank2 and bank2.strip():
-                                org2_output = f"{org2} - {bank2}".strip() if org2 else bank2
-                        
-                        results.append([
-                            name1_full, post1, org1_output, org_type1, company1, holding1, phone1,
-                            name2_full, post2, org2_output, org_type2, company2, holding2, phone2,
-                            final_score * 100  # Convert to percentage for readability
-                        ])
-        
-        df_result = pd.DataFrame(results, columns=[
-            "نام اول", "پست اول", "سازمان اول", "نوع سازمان اول", "عنوان شرکت اول", "عنوان هولدینگ اول", "شماره تلفن اول",
-            "نام دوم", "پست دوم", "سازمان دوم", "نوع سازمان دوم", "عنوان شرکت دوم", "عنوان هولدینگ دوم", "شماره تلفن دوم",
-            "درصد تشابه"
-        ])
+                        pair_is.append(i)
+                        pair_js.append(j)
+                        pair_scores.append(final_score * 100)  # Convert to percentage for readability
+        
+        # Modify organization title for output: if IsHead is False (0), append BankTitle with dash
+        org_outputs = list(orgs)
+        for k, (org, bank, is_head) in enumerate(zip(orgs, banks, is_heads)):
+            if is_head is not None and (is_head == 0 or is_head == False):
+                if bank and bank.strip():
+                    org_outputs[k] = f"{org} - {bank}".strip() if org else bank
+        
+        record_columns = [full_names, posts, org_outputs, org_types, companies, holdings, phones]
+        pair_is = np.array(pair_is, dtype=np.intp)
+        pair_js = np.array(pair_js, dtype=np.intp)
+        
+        columns = [np.array(values, dtype=object)[pair_is] for values in record_columns]
+        columns += [np.array(values, dtype=object)[pair_js] for values in record_columns]
+        columns.append(np.array(pair_scores, dtype=np.float64))
+        df_result = pd.DataFrame(dict(zip(RESULT_COLUMNS, columns)))
         df_result = df_result.sort_values("درصد تشابه", ascending=False)
         
         if output_path:
             output_ext = os.path.splitext(output_path)[1].lower()
             if output_ext == '.csv':
-                df_result.to_csv(output_path, index=False, encoding='utf-8-sig')
+                write_csv(df_result, output_path)
             else:
-                df_result.to_excel(output_path, index=False)
+                write_excel(df_result, output_path)
             logging.info(f"Results saved to {output_path}")
         
         return df_result
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+
     parser = argparse.ArgumentParser(
         description="Optimized Smart Name Processor for small datasets (up to 3000 records). "
                     "Processes names, extracts common first names, finds similar names based on fuzzy matching, "
@@ -331,6 +714,10 @@ if __name__ == "__main__":
     parser.add_argument("--org_threshold_for_post", type=float, default=0.60, help="Organization similarity threshold to calculate post similarity (0.0-1.0, default 0.60).")
     parser.add_argument("--use_shared_lastname_bonus", type=bool, default=True, help="Whether to use bonus for shared last name parts (True/False).")
     parser.add_argument("--shared_lastname_bonus", type=float, default=0.05, help="Bonus value for shared last name parts (0.0-1.0, default 0.05).")
+    parser.add_argument("--blocking_key_length", type=int, default=0, help="Only compare records whose last names share the first or last N characters (0 = compare all, default 0).")
+    parser.add_argument("--blocking_max_block_size", type=int, default=0, help="With blocking, split blocks on further characters until none is bigger than this (0 = fixed prefix/suffix blocks, default 0).")
+    parser.add_argument("--max_candidates", type=int, default=MAX_CANDIDATES_PER_RECORD, help=f"Score only the best N last-name candidates of each record (0 = score all, default {MAX_CANDIDATES_PER_RECORD}).")
+    parser.add_argument("--normalize_cache_dir", type=str, default=None, help="Cache normalized text columns in this directory and reuse them when the input is unchanged (default: no cache).")
 
     args = parser.parse_args()
 
@@ -345,7 +732,11 @@ if __name__ == "__main__":
             use_bank_bonus=args.use_bank_bonus,
             org_threshold_for_post=args.org_threshold_for_post,
             use_shared_lastname_bonus=args.use_shared_lastname_bonus,
-            shared_lastname_bonus=args.shared_lastname_bonus
+            shared_lastname_bonus=args.shared_lastname_bonus,
+            blocking_key_length=args.blocking_key_length,
+            blocking_max_block_size=args.blocking_max_block_size,
+            max_candidates_per_record=args.max_candidates,
+            normalize_cache_dir=args.normalize_cache_dir
     )
 
     start_time = time.time()  # Start timing